@@ -1,28 +1,67 @@
 import requests
+from requests.adapters import HTTPAdapter
 import os
+import atexit
+import logging
 import sqlite3
 import pytz
 import time
 import datetime
-import schedule
 import json
+import orjson
+import itertools
+import threading
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 API_BASE = ""
 AUTH_URL = ""
 CAMPUS_ID = ""
 CLUSTER_IDS = ["", "", "", ""]
+# В режиме WAL рядом с базой живут служебные файлы campus_attendance.db-wal
+# и campus_attendance.db-shm — их нельзя удалять при работающем сервисе
 DB_NAME = "campus_attendance.db"
 REPORT_FILE = "logins.txt"
 
+# SQL-запросы вынесены в константы, чтобы sqlite3 переиспользовал подготовленные выражения
+INSERT_ATTENDANCE_SQL = "INSERT OR IGNORE INTO attendance (check_time, login) VALUES (?, ?)"
+CREATE_VALID_LOGINS_SQL = "CREATE TEMP TABLE IF NOT EXISTS valid_logins (login TEXT PRIMARY KEY)"
+CLEAR_VALID_LOGINS_SQL = "DELETE FROM valid_logins"
+INSERT_VALID_LOGIN_SQL = "INSERT OR IGNORE INTO valid_logins (login) VALUES (?)"
+COUNT_UNIQUE_LOGINS_SQL = """
+    SELECT COUNT(DISTINCT a.login)
+    FROM attendance a JOIN valid_logins v ON a.login = v.login
+    WHERE a.check_time BETWEEN ? AND ?
+"""
+PEAK_MINUTE_SQL = """
+    SELECT strftime('%H:%M', a.check_time) AS bucket, COUNT(DISTINCT a.login)
+    FROM attendance a JOIN valid_logins v ON a.login = v.login
+    WHERE a.check_time BETWEEN ? AND ?
+    GROUP BY bucket
+    ORDER BY 2 DESC, bucket ASC
+    LIMIT 1
+"""
+
 # Учетные данные todo: вынести в файл конфигурации
 USERNAME = "login"
 PASSWORD = "pass"
 
+logger = logging.getLogger(__name__)
+
+# Общая HTTP-сессия: переиспользует TCP/TLS соединения между запросами
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
 # Глобальные переменные для хранения токенов
 access_token = None
 refresh_token = None
 token_expiry = None
+# Кластеры опрашиваются параллельно, обновление токена — строго в одном потоке
+token_lock = threading.Lock()
+
+# Единственное соединение с базой на весь процесс, см. get_db()
+db_conn = None
 
 
 def get_new_tokens(username=USERNAME, password=PASSWORD, use_refresh=False):
@@ -48,7 +87,7 @@ def get_new_tokens(username=USERNAME, password=PASSWORD, use_refresh=False):
         }
 
     try:
-        response = requests.post(AUTH_URL, headers=headers, data=data)
+        response = SESSION.post(AUTH_URL, headers=headers, data=data)
         response.raise_for_status()  # Вызовет исключение при ошибке HTTP
 
         token_data = response.json()
@@ -60,17 +99,17 @@ def get_new_tokens(username=USERNAME, password=PASSWORD, use_refresh=False):
         expires_in = token_data.get('expires_in', 3600)
         token_expiry = datetime.datetime.now() + datetime.timedelta(seconds=expires_in * 0.9)
 
-        print(f"Получены новые токены, действительны до {token_expiry}")
+        logger.info(f"Получены новые токены, действительны до {token_expiry}")
         return True
 
     except requests.exceptions.HTTPError as e:
-        print(f"Ошибка получения токенов: {e}")
+        logger.error(f"Ошибка получения токенов: {e}")
         if use_refresh:
-            print("Попытка получения новых токенов через логин/пароль...")
+            logger.info("Попытка получения новых токенов через логин/пароль...")
             return get_new_tokens(username, password, use_refresh=False)
         return False
     except Exception as e:
-        print(f"Непредвиденная ошибка при получении токенов: {e}")
+        logger.error(f"Непредвиденная ошибка при получении токенов: {e}")
         return False
 
 
@@ -80,24 +119,29 @@ def ensure_valid_token():
     """
     global access_token, token_expiry
 
-    # Если токена нет или срок его действия истек, получаем новый
-    if not access_token or token_expiry is None or datetime.datetime.now() >= token_expiry:
-        if refresh_token:
-            # Сначала пробуем через refresh token
-            if not get_new_tokens(use_refresh=True):
-                # Если не удалось обновить через refresh token, используем логин/пароль
+    with token_lock:
+        # Если токена нет или срок его действия истек, получаем новый
+        if not access_token or token_expiry is None or datetime.datetime.now() >= token_expiry:
+            if refresh_token:
+                # Сначала пробуем через refresh token
+                if not get_new_tokens(use_refresh=True):
+                    # Если не удалось обновить через refresh token, используем логин/пароль
+                    return get_new_tokens()
+                return True
+            else:
+                # Если нет refresh токена, сразу используем логин/пароль
                 return get_new_tokens()
-            return True
-        else:
-            # Если нет refresh токена, сразу используем логин/пароль
-            return get_new_tokens()
-    return True
+        return True
 
 
 def is_token_valid(response):
     """
     Проверяет ответ API на признаки недействительного токена
     """
+    # Успешный ответ не разбираем: тело декодируется один раз в get_cluster_logins
+    if 200 <= response.status_code < 300:
+        return True
+
     # Проверка кода ответа
     if response.status_code == 400:
         # Проверяем текст ответа
@@ -126,47 +170,71 @@ def is_token_valid(response):
 def get_cluster_logins(cluster_id):
     """Получение логинов пользователей в кластере"""
     if not ensure_valid_token():
-        print(f"Не удалось получить действующий токен для кластера {cluster_id}")
+        logger.error(f"Не удалось получить действующий токен для кластера {cluster_id}")
         return []
 
     url = f"{API_BASE}/clusters/{cluster_id}/map"
     headers = {"Authorization": f"Bearer {access_token}"}
 
-    resp = requests.get(url, headers=headers, timeout=10)
+    resp = SESSION.get(url, headers=headers, timeout=10)
 
     # Проверяем действительность токена
     if not is_token_valid(resp):
-        print("Токен недействителен, обновляем...")
+        logger.warning("Токен недействителен, обновляем...")
         if ensure_valid_token():
             # Повторяем запрос с новым токеном
             headers = {"Authorization": f"Bearer {access_token}"}
-            resp = requests.get(url, headers=headers)
+            resp = SESSION.get(url, headers=headers)
         else:
-            print("Не удалось обновить токен")
+            logger.error("Не удалось обновить токен")
             return []
 
     # Проверяем ответ
     if resp.status_code != 200:
-        print(f"Ошибка при получении карты кластера {cluster_id}: {resp.status_code} {resp.text}")
+        logger.error(f"Ошибка при получении карты кластера {cluster_id}: {resp.status_code} {resp.text}")
         return []
 
     try:
-        cluster_map = resp.json()
+        cluster_map = orjson.loads(resp.content)
     except Exception as e:
-        print(f"Ошибка при разборе ответа: {e}")
+        logger.error(f"Ошибка при разборе ответа: {e}")
         return []
 
     if not isinstance(cluster_map, dict) or 'clusterMap' not in cluster_map:
-        print("Некорректный формат ответа API")
+        logger.error("Некорректный формат ответа API")
         return []
 
     logins = [place['login'] for place in cluster_map['clusterMap'] if place.get('login')]
     return logins
 
 
+def connect_db():
+    """Открывает соединение с базой и применяет настройки производительности"""
+    # Автокоммит: транзакции открываются явно через BEGIN там, где они нужны
+    conn = sqlite3.connect(DB_NAME, isolation_level=None, cached_statements=256)
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-20000")
+    return conn
+
+
+def get_db():
+    """
+    Возвращает общее соединение с базой, открывая его при первом обращении.
+    Все обращения к базе идут из основного потока, поэтому соединение не делится между потоками
+    """
+    global db_conn
+    if db_conn is None:
+        db_conn = connect_db()
+        atexit.register(db_conn.close)
+    return db_conn
+
+
 def init_database():
     """Инициализация базы данных, если ее еще нет"""
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_db()
+    # WAL сохраняется в файле базы, достаточно включить один раз
+    conn.execute("PRAGMA journal_mode=WAL")
     cursor = conn.cursor()
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS attendance (
@@ -176,8 +244,12 @@ def init_database():
             UNIQUE(check_time, login)
         )
     ''')
-    conn.commit()
-    conn.close()
+    # Покрывающий индекс для выборок по диапазону времени
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_attendance_time_login ON attendance(check_time, login)"
+    )
+    # Обновляем статистику для планировщика запросов
+    cursor.execute("ANALYZE")
 
 
 def save_to_db(logins):
@@ -186,44 +258,46 @@ def save_to_db(logins):
         return
 
     now = datetime.datetime.now()
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_db()
     cursor = conn.cursor()
 
-    for login in logins:
-        try:
-            cursor.execute(
-                "INSERT INTO attendance (check_time, login) VALUES (?, ?)",
-                (now, login)
-            )
-        except sqlite3.IntegrityError:
-            # Пропускаем дубликаты
-            pass
-
+    # Одна транзакция на весь пакет, дубликаты пропускает сам SQLite
+    cursor.execute("BEGIN")
+    cursor.executemany(INSERT_ATTENDANCE_SQL, [(now, login) for login in logins])
     conn.commit()
-    conn.close()
-    print(f"{now}: Сохранено {len(logins)} логинов в базу данных")
+    logger.info(f"Сохранено {len(logins)} логинов в базу данных")
 
 
 def check_attendance():
     """Проверка присутствия в кампусе"""
-    all_logins = []
-    for cluster_id in CLUSTER_IDS:
-        logins = get_cluster_logins(cluster_id)
-        all_logins.extend(logins)
+    # Кластеры опрашиваются параллельно через общую сессию
+    with ThreadPoolExecutor(max_workers=len(CLUSTER_IDS)) as executor:
+        results = list(executor.map(get_cluster_logins, CLUSTER_IDS))
+    all_logins = list(itertools.chain.from_iterable(results))
 
-    now = datetime.datetime.now()
-    print(f"{now}: Обнаружено {len(all_logins)} залогиненных пользователей")
+    logger.info(f"Обнаружено {len(all_logins)} залогиненных пользователей")
 
     save_to_db(all_logins)
 
 
+@lru_cache(maxsize=1)
 def load_valid_student_logins(filename="students.txt"):
-    """Загружает список допустимых логинов студентов из файла"""
+    """
+    Загружает список допустимых логинов студентов из файла.
+    Результат кешируется: изменения в файле подхватываются после перезапуска сервиса
+    """
     if not os.path.exists(filename):
-        print(f"Файл {filename} не найден.")
-        return set()
+        logger.warning(f"Файл {filename} не найден.")
+        return frozenset()
     with open(filename, 'r', encoding='utf-8') as f:
-        return set(line.strip() for line in f if line.strip())
+        return frozenset(line.strip() for line in f if line.strip())
+
+
+def fill_valid_logins_table(cursor, valid_logins):
+    """Загружает допустимые логины во временную таблицу valid_logins для JOIN"""
+    cursor.execute(CREATE_VALID_LOGINS_SQL)
+    cursor.execute(CLEAR_VALID_LOGINS_SQL)
+    cursor.executemany(INSERT_VALID_LOGIN_SQL, [(login,) for login in valid_logins])
 
 
 def get_weekly_unique_logins():
@@ -233,19 +307,13 @@ def get_weekly_unique_logins():
     start_time = datetime.datetime.combine(today - datetime.timedelta(days=6), datetime.time(7, 0))
     end_time = datetime.datetime.combine(today, datetime.time(20, 45))
 
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-
-    cursor.execute(
-        "SELECT DISTINCT login FROM attendance WHERE check_time BETWEEN ? AND ?",
-        (start_time, end_time)
-    )
-    records = cursor.fetchall()
-    conn.close()
+    cursor = get_db().cursor()
+    fill_valid_logins_table(cursor, valid_logins)
 
-     # Фильтрация по допустимым логинам
-    filtered_logins = {login for (login,) in records if login in valid_logins}
-    return len(filtered_logins)
+    # Фильтрация по допустимым логинам выполняется в SQLite через JOIN
+    cursor.execute(COUNT_UNIQUE_LOGINS_SQL, (start_time, end_time))
+    count = cursor.fetchone()[0]
+    return count
 
 def get_days_until_deadline():
     """Возвращает количество дней до следующего дедлайна"""
@@ -262,45 +330,17 @@ def generate_daily_report():
     
     valid_logins = load_valid_student_logins()  # <-- Загружаем валидные логины
 
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-
-    # Получаем все записи за сегодня между 7:00 и 20:45
-    cursor.execute(
-        "SELECT check_time, login FROM attendance WHERE check_time BETWEEN ? AND ?",
-        (start_time, end_time)
-    )
-    records = cursor.fetchall()
-
-    # Подсчитываем уникальные логины
-    unique_logins = set()
-    time_login_counts = {}
+    cursor = get_db().cursor()
+    fill_valid_logins_table(cursor, valid_logins)
 
-    for check_time_str, login in records:
-        if login not in valid_logins:
-            continue  # Пропускаем, если логин не из списка студентов
-    
-        unique_logins.add(login)
+    # Уникальные логины студентов за сегодня между 7:00 и 20:45
+    cursor.execute(COUNT_UNIQUE_LOGINS_SQL, (start_time, end_time))
+    unique_count = cursor.fetchone()[0]
 
-        # Округляем время до получаса для подсчета пиковой нагрузки
-        check_time = datetime.datetime.fromisoformat(check_time_str)
-        time_key = check_time.replace(second=0, microsecond=0)
-
-        if time_key not in time_login_counts:
-            time_login_counts[time_key] = set()
-        time_login_counts[time_key].add(login)
-
-    # Находим время с максимальным количеством логинов
-    peak_time = None
-    peak_count = 0
-
-    for time_key, logins_set in time_login_counts.items():
-        count = len(logins_set)
-        if count > peak_count:
-            peak_count = count
-            peak_time = time_key
-
-    conn.close()
+    # Минута с максимальным количеством логинов (при равенстве — самая ранняя)
+    cursor.execute(PEAK_MINUTE_SQL, (start_time, end_time))
+    peak = cursor.fetchone()
+    peak_time = peak[0] if peak else None
 
     # Формируем отчет
     lines = ["🏫 **Посещаемость и срок сдачи:**"]
@@ -313,15 +353,15 @@ def generate_daily_report():
         lines.append(f"- Уник. логинов за неделю: {weekly_logins}")
 
     # Добавляем данные за текущий день
-    lines.append(f"- Уник. логинов за день: {len(unique_logins)}")
+    lines.append(f"- Уник. логинов за день: {unique_count}")
     if peak_time:
-        lines.append(f"- Час пик: {peak_time.strftime('%H:%M')}")
+        lines.append(f"- Час пик: {peak_time}")
 
     # Записываем отчет в файл
     with open(REPORT_FILE, 'w', encoding='utf-8') as f:
         f.write('\n'.join(lines))
 
-    print(f"Отчет за {today} сохранен в {REPORT_FILE}")
+    logger.info(f"Отчет за {today} сохранен в {REPORT_FILE}")
 
 
 def is_working_hour():
@@ -332,34 +372,50 @@ def is_working_hour():
     return start <= now <= end
 
 
+# Расписание: проверки каждые 15 минут с 7:00 до 20:45 и отчет в 20:50
+SCHEDULE = [
+    (datetime.time(hour, minute), check_attendance)
+    for hour in range(7, 21)
+    for minute in (0, 15, 30, 45)
+] + [(datetime.time(20, 50), generate_daily_report)]
+
+
+def next_scheduled_run(after):
+    """Возвращает (время запуска, задача) для ближайшего события строго позже after"""
+    for day_offset in (0, 1):
+        day = after.date() + datetime.timedelta(days=day_offset)
+        for run_time, job in SCHEDULE:
+            run_at = datetime.datetime.combine(day, run_time)
+            if run_at > after:
+                return run_at, job
+
+
 def main():
     """Основная функция для запуска как сервис"""
-    print("Запуск сервиса мониторинга кампуса...")
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)s: %(message)s',
+        level=logging.INFO
+    )
+    logging.getLogger("urllib3").setLevel(logging.WARNING)
+    logger.info("Запуск сервиса мониторинга кампуса...")
     init_database()
 
     # Получаем токены при запуске
     if not ensure_valid_token():
-        print("Не удалось получить токены при запуске. Проверьте учетные данные.")
+        logger.error("Не удалось получить токены при запуске. Проверьте учетные данные.")
         return
 
-    # Планируем проверки каждые 15 минут в рабочее время
-    for hour in range(7, 21):
-        for minute in [0, 15, 30, 45]:
-            if hour == 20 and minute > 45:
-                continue
-            schedule.every().day.at(f"{hour:02d}:{minute:02d}").do(check_attendance)
-
-    # Планируем генерацию отчета в 20:50
-    schedule.every().day.at("20:50").do(generate_daily_report)
-
     # Проверяем сразу при запуске, если время рабочее
     if is_working_hour():
         check_attendance()
 
-    # Основной цикл
+    # Основной цикл: спим ровно до следующего события расписания
+    last_run = datetime.datetime.now()
     while True:
-        schedule.run_pending()
-        time.sleep(60)  # Проверяем расписание каждую минуту
+        run_at, job = next_scheduled_run(max(last_run, datetime.datetime.now()))
+        time.sleep(max(0, (run_at - datetime.datetime.now()).total_seconds()))
+        job()
+        last_run = run_at
 
 
 if __name__ == "__main__":
@@ -1,30 +1,40 @@
-import requests
+import aiohttp
 import json
+import orjson
 import time
 import re
-from datetime import datetime
-from typing import Dict, Set, List, Optional
+from datetime import datetime, timedelta
+from typing import Dict, FrozenSet, List, Optional, Tuple
 import os
 import asyncio
+import logging
 from telegram import Bot
-import traceback
+from telegram.error import BadRequest, RetryAfter
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
+
+logger = logging.getLogger(__name__)
 
 # === ГЛОБАЛЬНЫЕ ПЕРЕМЕННЫЕ ===
-known_message_ids: Dict[str, Set[str]] = {}  # {room_id: {message_ids}}
+# Хранит только ID из последнего ответа API, поэтому не растет со временем
+known_message_ids: Dict[str, FrozenSet[str]] = {}  # {room_id: {message_ids}}
 
-def escape_markdown_v2(text: str) -> str:
-    # Все зарезервированные символы MarkdownV2 (включая точку и обратный слэш)
-    specials_re = re.compile(r'([_\*\[\]\(\)~`>#+\-=|{}\.\!\\])')
+# Файл, в котором known_message_ids переживает перезапуск процесса
+KNOWN_IDS_FILE = "known_ids.json"
+
+# Все зарезервированные символы MarkdownV2 (включая точку и обратный слэш)
+SPECIALS_RE = re.compile(r'([_\*\[\]\(\)~`>#+\-=|{}\.\!\\])')
 
-    # Находит либо ссылку [text](url), либо парный *...*
-    token_re = re.compile(r'(\[[^\]]+\]\([^\)]+\))|(\*([^*]+?)\*)', flags=re.DOTALL)
+# Находит либо ссылку [text](url), либо парный *...*
+TOKEN_RE = re.compile(r'(\[[^\]]+\]\([^\)]+\))|(\*([^*]+?)\*)', flags=re.DOTALL)
 
-    def escape_all(s: str) -> str:
-        return specials_re.sub(lambda m: '\\' + m.group(1), s)
+def escape_all(s: str) -> str:
+    """Экранирует все спецсимволы MarkdownV2"""
+    return SPECIALS_RE.sub(r'\\\1', s)
 
+def escape_markdown_v2(text: str) -> str:
     parts = []
     last = 0
-    for m in token_re.finditer(text):
+    for m in TOKEN_RE.finditer(text):
         # участок до токена — экранируем полностью
         before = text[last:m.start()]
         if before:
@@ -63,7 +73,7 @@ def load_config(config_path: str = "config.txt") -> Dict[str, str]:
     
     # Пытаемся загрузить конфигурацию из файла
     if os.path.exists(config_path):
-        print(f"Загрузка конфигурации из {config_path}...")
+        logger.info(f"Загрузка конфигурации из {config_path}...")
         try:
             with open(config_path, 'r', encoding='utf-8') as f:
                 lines = f.readlines()
@@ -85,11 +95,11 @@ def load_config(config_path: str = "config.txt") -> Dict[str, str]:
                         config[key] = value
                         
         except Exception as e:
-            print(f"Ошибка чтения конфигурации: {e}")
+            logger.error(f"Ошибка чтения конфигурации: {e}")
     else:
-        print(f"Файл конфигурации {config_path} не найден. Создаю шаблон...")
+        logger.warning(f"Файл конфигурации {config_path} не найден. Создаю шаблон...")
         create_config_template(config_path, default_config)
-        print(f"Шаблон создан. Пожалуйста, заполните {config_path} и запустите скрипт снова.")
+        logger.warning(f"Шаблон создан. Пожалуйста, заполните {config_path} и запустите скрипт снова.")
         exit(1)
     
     # Применяем значения по умолчанию для отсутствующих параметров
@@ -102,8 +112,8 @@ def load_config(config_path: str = "config.txt") -> Dict[str, str]:
     missing_params = [p for p in required_params if not config.get(p)]
     
     if missing_params:
-        print(f"Ошибка: Отсутствуют обязательные параметры в конфигурации: {', '.join(missing_params)}")
-        print(f"Пожалуйста, заполните их в файле {config_path}")
+        logger.error(f"Ошибка: Отсутствуют обязательные параметры в конфигурации: {', '.join(missing_params)}")
+        logger.error(f"Пожалуйста, заполните их в файле {config_path}")
         exit(1)
     
     return config
@@ -147,7 +157,7 @@ POST_THREAD_ID=  # ID конкретного треда
         with open(config_path, 'w', encoding='utf-8') as f:
             f.write(template)
     except Exception as e:
-        print(f"Ошибка создания шаблона конфигурации: {e}")
+        logger.error(f"Ошибка создания шаблона конфигурации: {e}")
 
 def parse_list_param(param: str) -> List[str]:
     """Преобразует строку с разделителями-запятыми в список"""
@@ -155,7 +165,26 @@ def parse_list_param(param: str) -> List[str]:
         return []
     return [item.strip() for item in param.split(',') if item.strip()]
 
-def get_messages_from_room(room_id: str, room_type: str, config: Dict[str, str]) -> List[Dict]:
+def get_rooms_to_check(config: Dict[str, str]) -> List[Tuple[str, str]]:
+    """Возвращает список отслеживаемых комнат в виде пар (тип, id)"""
+    group_ids = parse_list_param(config.get('ROCKET_GROUP_IDS', ''))
+    channel_ids = parse_list_param(config.get('ROCKET_CHANNEL_IDS', ''))
+    return [("group", room_id) for room_id in group_ids] + [("channel", room_id) for room_id in channel_ids]
+
+@retry(
+    retry=retry_if_exception_type((aiohttp.ClientError, asyncio.TimeoutError)),
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=0.5, max=4),
+    reraise=True
+)
+async def fetch_room_data(session: aiohttp.ClientSession, url: str, params: Dict[str, str]) -> Dict:
+    """Запрос к API RocketChat с повторами при сетевых ошибках"""
+    async with session.get(url, params=params) as response:
+        response.raise_for_status()
+        return orjson.loads(await response.read())
+
+async def get_messages_from_room(session: aiohttp.ClientSession, room_id: str, room_type: str,
+                                 config: Dict[str, str]) -> List[Dict]:
     """Получает сообщения из комнаты (группы или канала)"""
     
     # Определяем URL в зависимости от типа комнаты
@@ -164,32 +193,25 @@ def get_messages_from_room(room_id: str, room_type: str, config: Dict[str, str])
     elif room_type == "channel":
         endpoint = "/api/v1/channels.messages"
     else:
-        print(f"Неизвестный тип комнаты: {room_type}")
+        logger.error(f"Неизвестный тип комнаты: {room_type}")
         return []
     
     url = f"{config['ROCKET_URL']}{endpoint}"
-    headers = {
-        "X-Auth-Token": config['ROCKET_USER_TOKEN'],
-        "X-User-Id": config['ROCKET_USER_ID'],
-        "Content-Type": "application/json"
-    }
     params = {
         "roomId": room_id
     }
     
     try:
-        response = requests.get(url, headers=headers, params=params)
-        response.raise_for_status()
-        
-        data = response.json()
+        # Заголовки авторизации заданы при создании сессии (см. main)
+        data = await fetch_room_data(session, url, params)
         if data.get("success", False):
             return data.get("messages", [])
         else:
-            print(f"Ошибка API для {room_type} {room_id}: {data}")
+            logger.error(f"Ошибка API для {room_type} {room_id}: {data}")
             return []
             
-    except requests.exceptions.RequestException as e:
-        print(f"Ошибка запроса для {room_type} {room_id}: {e}")
+    except (aiohttp.ClientError, asyncio.TimeoutError, orjson.JSONDecodeError) as e:
+        logger.error(f"Ошибка запроса для {room_type} {room_id}: {e}")
         return []
 
 def format_message(message: Dict, room_type: str, room_id: str) -> str:
@@ -225,79 +247,107 @@ def should_show_message(message: Dict, filter_users: List[str]) -> bool:
     # Проверяем, входит ли пользователь в список фильтра
     return username in filter_users
 
-def initialize_known_messages(config: Dict[str, str]):
+def load_known_messages(path: str = KNOWN_IDS_FILE) -> bool:
+    """Загружает известные ID сообщений из файла, возвращает True при успехе"""
+    if not os.path.exists(path):
+        return False
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        for storage_key, message_ids in data.items():
+            known_message_ids[storage_key] = frozenset(message_ids)
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка чтения {path}: {e}")
+        return False
+
+def save_known_messages(path: str = KNOWN_IDS_FILE):
+    """Атомарно сохраняет известные ID сообщений в файл (через временный файл)"""
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({k: list(v) for k, v in known_message_ids.items()}, f)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        logger.error(f"Ошибка сохранения {path}: {e}")
+
+async def initialize_known_messages(session: aiohttp.ClientSession, config: Dict[str, str]):
     """Инициализирует известные сообщения при запуске"""
-    print("=" * 50)
-    print("ИНИЦИАЛИЗАЦИЯ МОНИТОРИНГА")
-    print("=" * 50)
+    logger.info("Инициализация мониторинга")
     
     group_ids = parse_list_param(config.get('ROCKET_GROUP_IDS', ''))
     channel_ids = parse_list_param(config.get('ROCKET_CHANNEL_IDS', ''))
     filter_users = parse_list_param(config.get('ROCKET_FILTER_USERS', ''))
     
-    print(f"Групп для мониторинга: {len(group_ids)}")
-    print(f"Каналов для мониторинга: {len(channel_ids)}")
-    print(f"Интервал проверки: {config.get('ROCKET_CHECK_INTERVAL', '1')} минут")
+    logger.info(f"Групп для мониторинга: {len(group_ids)}")
+    logger.info(f"Каналов для мониторинга: {len(channel_ids)}")
+    logger.info(f"Интервал проверки: {config.get('ROCKET_CHECK_INTERVAL', '1')} минут")
     
     if filter_users:
-        print(f"Фильтр пользователей: {', '.join(filter_users)}")
+        logger.info(f"Фильтр пользователей: {', '.join(filter_users)}")
     else:
-        print("Фильтр пользователей: отключен (показываются все)")
+        logger.info("Фильтр пользователей: отключен (показываются все)")
     
-    print("-" * 50)
+    rooms = get_rooms_to_check(config)
     
-    # Инициализация групп
-    for room_id in group_ids:
-        print(f"Загрузка сообщений из группы {room_id}...")
-        messages = get_messages_from_room(room_id, "group", config)
-        if messages:
-            message_ids = {msg["_id"] for msg in messages if "_id" in msg}
-            known_message_ids[f"group_{room_id}"] = message_ids
-            print(f"  Загружено {len(message_ids)} сообщений")
-        else:
-            known_message_ids[f"group_{room_id}"] = set()
-            print(f"  Сообщения не найдены или ошибка доступа")
+    # Комнаты, сохраненные с прошлого запуска, повторно не загружаем
+    if load_known_messages():
+        logger.info(f"Известные сообщения загружены из {KNOWN_IDS_FILE}")
+        rooms = [(room_type, room_id) for room_type, room_id in rooms
+                 if f"{room_type}_{room_id}" not in known_message_ids]
     
-    # Инициализация каналов
-    for room_id in channel_ids:
-        print(f"Загрузка сообщений из канала {room_id}...")
-        messages = get_messages_from_room(room_id, "channel", config)
+    # Загружаем все комнаты параллельно
+    results = await asyncio.gather(*[
+        get_messages_from_room(session, room_id, room_type, config)
+        for room_type, room_id in rooms
+    ])
+    
+    for (room_type, room_id), messages in zip(rooms, results):
+        room_name = "группы" if room_type == "group" else "канала"
+        logger.info(f"Загрузка сообщений из {room_name} {room_id}...")
         if messages:
-            message_ids = {msg["_id"] for msg in messages if "_id" in msg}
-            known_message_ids[f"channel_{room_id}"] = message_ids
-            print(f"  Загружено {len(message_ids)} сообщений")
+            message_ids = frozenset(msg["_id"] for msg in messages if "_id" in msg)
+            known_message_ids[f"{room_type}_{room_id}"] = message_ids
+            logger.info(f"  Загружено {len(message_ids)} сообщений")
         else:
-            known_message_ids[f"channel_{room_id}"] = set()
-            print(f"  Сообщения не найдены или ошибка доступа")
+            known_message_ids[f"{room_type}_{room_id}"] = frozenset()
+            logger.warning("  Сообщения не найдены или ошибка доступа")
+    
+    save_known_messages()
     
-    print("=" * 50)
-    print("Инициализация завершена. Мониторинг новых сообщений...")
-    print("=" * 50 + "\n")
+    logger.info("Инициализация завершена. Мониторинг новых сообщений...")
+
+async def send_with_retry(bot: Bot, send_args: Dict):
+    """Отправляет сообщение в Telegram; при RetryAfter ждет указанное время и повторяет один раз"""
+    try:
+        await bot.send_message(**send_args)
+    except RetryAfter as e:
+        delay = e.retry_after
+        if isinstance(delay, timedelta):
+            delay = delay.total_seconds()
+        logger.warning(f"Telegram ограничил частоту отправки, ждем {delay} с")
+        await asyncio.sleep(delay)
+        await bot.send_message(**send_args)
 
-async def check_for_new_messages(config: Dict[str, str], bot: Bot):
+async def check_for_new_messages(session: aiohttp.ClientSession, config: Dict[str, str], bot: Bot,
+                                 rooms_to_check: List[Tuple[str, str]], filter_users: List[str],
+                                 chat_id: int, thread_id: int):
     """Проверяет новые сообщения во всех отслеживаемых комнатах"""
-    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print(f"[{current_time}] Проверка новых сообщений...")
-    
-    group_ids = parse_list_param(config.get('ROCKET_GROUP_IDS', ''))
-    channel_ids = parse_list_param(config.get('ROCKET_CHANNEL_IDS', ''))
-    filter_users = parse_list_param(config.get('ROCKET_FILTER_USERS', ''))
+    logger.debug("Проверка новых сообщений...")
     
     total_new_messages = 0
-    rooms_to_check = []
+    known_changed = False
     
-    # Добавляем группы в список проверки
-    for room_id in group_ids:
-        rooms_to_check.append(("group", room_id))
+    # Опрашиваем все комнаты параллельно
+    results = await asyncio.gather(*[
+        get_messages_from_room(session, room_id, room_type, config)
+        for room_type, room_id in rooms_to_check
+    ])
     
-    # Добавляем каналы в список проверки
-    for room_id in channel_ids:
-        rooms_to_check.append(("channel", room_id))
+    to_send = []
     
-    # Проверяем каждую комнату
-    for room_type, room_id in rooms_to_check:
-        messages = get_messages_from_room(room_id, room_type, config)
-        
+    # Обрабатываем каждую комнату
+    for (room_type, room_id), messages in zip(rooms_to_check, results):
         if not messages:
             continue
         
@@ -305,10 +355,15 @@ async def check_for_new_messages(config: Dict[str, str], bot: Bot):
         
         # Инициализируем, если комната новая
         if storage_key not in known_message_ids:
-            known_message_ids[storage_key] = set()
+            known_message_ids[storage_key] = frozenset()
+            known_changed = True
         
         # Получаем ID всех текущих сообщений
-        current_message_ids = {msg["_id"] for msg in messages if "_id" in msg}
+        current_message_ids = frozenset(msg["_id"] for msg in messages if "_id" in msg)
+        
+        # Обычный случай — ничего не изменилось, разность не считаем
+        if current_message_ids == known_message_ids[storage_key]:
+            continue
         
         # Находим новые сообщения
         new_message_ids = current_message_ids - known_message_ids[storage_key]
@@ -330,7 +385,7 @@ async def check_for_new_messages(config: Dict[str, str], bot: Bot):
                 filtered_messages.sort(key=lambda x: x.get("ts", ""))
                 
                 for message in filtered_messages:
-                    print(format_message(message, room_type, room_id))
+                    logger.info(format_message(message, room_type, room_id))
                     
                     username = message.get("u", {}).get("username", "unknown")
                     msg_text = message.get("msg", "")
@@ -338,31 +393,64 @@ async def check_for_new_messages(config: Dict[str, str], bot: Bot):
                     escaped_msg = escape_markdown_v2(msg_text)
                     
                     telegram_message = f"🚀 *{escaped_user}:*\n{escaped_msg}\n"
-                    
-                    await bot.send_message(
-                        chat_id=int(config['TARGET_CHAT_ID']),
+                    to_send.append((storage_key, message["_id"], dict(
+                        chat_id=chat_id,
                         text=telegram_message,
                         parse_mode="MarkdownV2",
-                        message_thread_id=int(config['POST_THREAD_ID'])
-                    )
+                        message_thread_id=thread_id
+                    )))
                     
                     total_new_messages += 1
             
-            # Обновляем список известных сообщений (включая все новые)
+            # Обновляем список известных сообщений (включая все новые).
+            # Множество заменяется, а не объединяется: API и так отдает только
+            # последние сообщения комнаты, поэтому размер остается ограниченным
             known_message_ids[storage_key] = current_message_ids
+            known_changed = True
+    
+    # Отправляем в Telegram строго по очереди: все сообщения идут в один тред,
+    # и параллельные отправки Telegram может опубликовать не в том порядке
+    for i, (storage_key, message_id, send_args) in enumerate(to_send):
+        try:
+            await send_with_retry(bot, send_args)
+        except BadRequest as e:
+            # Повтор не поможет (например, ошибка разметки) — сообщение остается известным
+            logger.error(f"Telegram отклонил сообщение {message_id}: {e}")
+        except Exception as e:
+            logger.error(f"Ошибка отправки в Telegram: {e}")
+            # Не отмечаем известными это и все следующие сообщения — они уйдут
+            # повторно при следующей проверке и в том же порядке
+            for unsent_key, unsent_id, _ in to_send[i:]:
+                known_message_ids[unsent_key] = known_message_ids[unsent_key] - {unsent_id}
+            break
+    
+    # Сохраняем только после отправки, чтобы неотправленные ID не попали в файл
+    if known_changed:
+        save_known_messages()
     
     if total_new_messages == 0:
-        print("  Новых сообщений нет")
+        logger.debug("  Новых сообщений нет")
     else:
-        print(f"  Всего новых сообщений: {total_new_messages}")
+        logger.info(f"  Всего новых сообщений: {total_new_messages}")
 
 async def main():
     """Главная функция программы"""
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)s: %(message)s',
+        level=logging.INFO
+    )
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    logging.getLogger("telegram").setLevel(logging.WARNING)
+    
     # Загружаем конфигурацию
     config = load_config()
     
-    # Инициализируем известные сообщения
-    initialize_known_messages(config)
+    # Общая HTTP-сессия RocketChat: держит keep-alive соединения между опросами
+    session = aiohttp.ClientSession(headers={
+        "X-Auth-Token": config['ROCKET_USER_TOKEN'],
+        "X-User-Id": config['ROCKET_USER_ID'],
+        "Content-Type": "application/json"
+    })
     
     # Создаем Telegram бот
     bot = Bot(token=config['TOKEN'])
@@ -370,17 +458,28 @@ async def main():
     # Получаем интервал проверки
     check_interval = int(config.get('ROCKET_CHECK_INTERVAL', '1'))
     
+    # Разбираем списки комнат, фильтр и ID чата один раз при старте
+    rooms_to_check = get_rooms_to_check(config)
+    filter_users = parse_list_param(config.get('ROCKET_FILTER_USERS', ''))
+    chat_id = int(config['TARGET_CHAT_ID'])
+    thread_id = int(config['POST_THREAD_ID'])
+    
     try:
+        # Инициализируем известные сообщения
+        await initialize_known_messages(session, config)
+        
         while True:
-            await check_for_new_messages(config, bot)
-            print(f"Ожидание {check_interval} минут до следующей проверки...\n")
+            await check_for_new_messages(session, config, bot, rooms_to_check, filter_users,
+                                         chat_id, thread_id)
+            logger.debug(f"Ожидание {check_interval} минут до следующей проверки...")
             await asyncio.sleep(check_interval * 60)
             
     except KeyboardInterrupt:
-        print("\n\nМониторинг остановлен пользователем")
+        logger.info("Мониторинг остановлен пользователем")
     except Exception as e:
-        print(f"\nНеожиданная ошибка: {e}")
-        traceback.print_exc()
+        logger.exception(f"Неожиданная ошибка: {e}")
+    finally:
+        await session.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -3,10 +3,13 @@ import sys
 import sqlite3
 import logging
 import asyncio
-import pytz
+import threading
 import re
-from datetime import datetime, timedelta, time as dt_time
+from contextlib import closing
+from datetime import date, datetime, timedelta, time as dt_time
+from functools import lru_cache
 from pathlib import Path
+from zoneinfo import ZoneInfo
 
 from telegram import Update, Chat, Message
 from telegram.ext import (
@@ -17,11 +20,19 @@ from telegram.ext import (
 )
 
 from google import genai
+import aiosqlite
 
 # --- Константы ---
 CONFIG_PATH = 'config.txt'
 DB_PATH = 'messages.db'
 MESSAGES_DIR = 'messages'
+FLUSH_BATCH_SIZE = 500
+EXPORT_BUFFER_SIZE = 1 << 20  # 1 MiB вместо стандартных 8 KiB
+GROUP_CHAT_TYPES = frozenset({'group', 'supergroup'})
+START_DATE = date(2025, 4, 23)  # первый день основы
+
+# Синхронное соединение (чтение, служебные запросы) делится между потоками — доступ через блокировку
+db_lock = threading.Lock()
 
 # --- Логгирование ---
 logging.basicConfig(
@@ -57,100 +68,224 @@ def read_config(path):
     else:
         config['SUMMARY_TOPIC_ID'] = None
     config['MAX_SUMMARY_SIZE'] = int(config['MAX_SUMMARY_SIZE'])
-    config['IGNORED_TOPIC_IDS'] = [
+    # Часовой пояс и время событий разбираются один раз при старте
+    config['TZ'] = ZoneInfo('Europe/Moscow')
+    config['TIME_EXPORT'] = dt_time.fromisoformat(config['TIME_EXPORT'])
+    config['TIME_POST'] = dt_time.fromisoformat(config['TIME_POST'])
+    # Как часто (в секундах) буфер входящих сообщений сбрасывается в базу
+    config['FLUSH_INTERVAL'] = int(config.get('FLUSH_INTERVAL') or 5)
+    # frozenset: проверка топика в on_message за O(1)
+    config['IGNORED_TOPIC_IDS'] = frozenset(
         int(x) for x in config.get('IGNORED_TOPIC_IDS', '').split(',') if x.strip().isdigit()
-    ]
+    )
     # Новый ключ для Gemini
     config['GEMINI_API_KEY'] = config.get('GEMINI_API_KEY', '')
     return config
 
+# --- SQL-запросы ---
+# Все запросы — константы модуля: sqlite3 кеширует подготовленные выражения по тексту SQL
+CREATE_MESSAGES_SQL = '''
+    CREATE TABLE IF NOT EXISTS messages (
+        message_id INTEGER PRIMARY KEY,
+        username TEXT,
+        message_text TEXT,
+        timestamp INTEGER NOT NULL,
+        chat_id INTEGER,
+        thread_id INTEGER
+    )
+'''
+CREATE_MESSAGES_INDEX_SQL = (
+    'CREATE INDEX IF NOT EXISTS idx_msg_chat_ts ON messages(chat_id, timestamp, thread_id)'
+)
+INSERT_MESSAGE_SQL = '''
+    INSERT OR IGNORE INTO messages (message_id, username, message_text, timestamp, chat_id, thread_id)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+CREATE_IGNORED_THREADS_SQL = (
+    'CREATE TEMP TABLE IF NOT EXISTS ignored_threads (thread_id INTEGER PRIMARY KEY)'
+)
+CLEAR_IGNORED_THREADS_SQL = 'DELETE FROM ignored_threads'
+INSERT_IGNORED_THREAD_SQL = 'INSERT OR IGNORE INTO ignored_threads (thread_id) VALUES (?)'
+STATEMENT_CACHE_SIZE = 256
+
+# --- Соединение с базой ---
+def open_db(db_path):
+    # WAL + synchronous=NORMAL: запись сообщения — добавление кадра в журнал, без лишних fsync
+    conn = sqlite3.connect(
+        db_path,
+        check_same_thread=False,
+        isolation_level=None,
+        cached_statements=STATEMENT_CACHE_SIZE
+    )
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    return conn
+
+# --- Время сообщений хранится как INTEGER: микросекунды от эпохи (UTC) ---
+def to_epoch_us(dt):
+    return int(dt.timestamp() * 1_000_000)
+
+# Строки старой схемы, чей timestamp SQLite не может разобрать; миграция их бы потеряла
+COUNT_BAD_TIMESTAMPS_SQL = "SELECT COUNT(*) FROM messages WHERE strftime('%s', timestamp) IS NULL"
+
+# Одноразовая миграция старой схемы, где timestamp был ISO-строкой (TEXT)
+MIGRATE_TIMESTAMPS_SQL = '''
+    BEGIN;
+    ALTER TABLE messages RENAME TO messages_old;
+''' + CREATE_MESSAGES_SQL + ''';
+    INSERT INTO messages (message_id, username, message_text, timestamp, chat_id, thread_id)
+        SELECT message_id, username, message_text,
+               CAST(strftime('%s', timestamp) AS INTEGER) * 1000000,
+               chat_id, thread_id
+        FROM messages_old;
+    DROP TABLE messages_old;
+    COMMIT;
+'''
+
+def migrate_timestamps(conn):
+    # Не теряем архив молча: если часть строк не переносится, миграцию не начинаем
+    bad_rows = conn.execute(COUNT_BAD_TIMESTAMPS_SQL).fetchone()[0]
+    if bad_rows:
+        logger.error(f"{bad_rows} messages have unparseable timestamps, migration aborted")
+        raise RuntimeError(f"Fix or delete {bad_rows} messages with unparseable timestamps in {DB_PATH}")
+    logger.info("Migrating messages.timestamp from ISO text to epoch microseconds")
+    try:
+        conn.executescript(MIGRATE_TIMESTAMPS_SQL)
+    except sqlite3.Error:
+        # executescript оставляет BEGIN открытым, если упал посреди скрипта
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+
+# --- Игнорируемые топики во временной таблице соединения ---
+def set_ignored_threads(conn, ignored_thread_ids):
+    with db_lock:
+        conn.execute(CREATE_IGNORED_THREADS_SQL)
+        conn.execute('BEGIN')
+        conn.execute(CLEAR_IGNORED_THREADS_SQL)
+        conn.executemany(INSERT_IGNORED_THREAD_SQL, [(thread_id,) for thread_id in ignored_thread_ids])
+        conn.execute('COMMIT')
+
 # --- Инициализация базы ---
-def init_db(db_path):
-    conn = sqlite3.connect(db_path)
+def init_db(conn, ignored_thread_ids):
     c = conn.cursor()
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS messages (
-            message_id INTEGER PRIMARY KEY,
-            username TEXT,
-            message_text TEXT,
-            timestamp TEXT,
-            chat_id INTEGER,
-            thread_id INTEGER
+    columns = {row[1]: row[2] for row in c.execute('PRAGMA table_info(messages)')}
+    if columns.get('timestamp', '').upper() == 'TEXT':
+        migrate_timestamps(conn)
+    c.execute(CREATE_MESSAGES_SQL)
+    # Индекс под выборку за период в fetch_messages_for_period
+    c.execute(CREATE_MESSAGES_INDEX_SQL)
+    # Обновляем статистику, чтобы планировщик запросов выбрал индекс
+    c.execute('ANALYZE')
+    set_ignored_threads(conn, ignored_thread_ids)
+
+# --- Запись сообщений в базу ---
+class MessageWriter:
+    """
+    Единственный писатель в базу: on_message кладет строки в очередь,
+    а фоновая задача пишет их пачками через aiosqlite, не блокируя event loop
+    """
+
+    def __init__(self, batch_size=FLUSH_BATCH_SIZE, interval=5):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue = asyncio.Queue()
+        self.db = None
+        self.task = None
+
+    async def start(self, db_path):
+        self.db = await aiosqlite.connect(
+            db_path, isolation_level=None, cached_statements=STATEMENT_CACHE_SIZE
         )
-    ''')
-    conn.commit()
-    conn.close()
+        await self.db.execute('PRAGMA journal_mode=WAL')
+        await self.db.execute('PRAGMA synchronous=NORMAL')
+        await self.db.execute('PRAGMA temp_store=MEMORY')
+        self.task = asyncio.create_task(self.run())
+
+    def add(self, row):
+        self.queue.put_nowait(row)
+
+    async def flush(self):
+        # Дожидаемся, пока все поставленные в очередь строки окажутся в базе
+        await self.queue.join()
+
+    async def close(self):
+        await self.flush()
+        self.task.cancel()
+        await self.db.close()
+
+    async def run(self):
+        while True:
+            batch = [await self.queue.get()]
+            # Если пачка еще не набралась, даем сообщениям накопиться interval секунд
+            if self.queue.qsize() < self.batch_size - 1:
+                await asyncio.sleep(self.interval)
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            try:
+                await self.db.execute('BEGIN')
+                await self.db.executemany(INSERT_MESSAGE_SQL, batch)
+                await self.db.execute('COMMIT')
+                logger.info(f"Flushed {len(batch)} messages to the database")
+            except Exception as e:
+                logger.error(f"Failed to write {len(batch)} messages: {e}")
+                if self.db.in_transaction:
+                    await self.db.execute('ROLLBACK')
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+# --- Выборка сообщений чата за период (без игнорируемых топиков) ---
+# Игнорируемые топики лежат во временной таблице ignored_threads, поэтому текст
+# запросов не зависит от их количества и подготовленные выражения переиспользуются
+PERIOD_WHERE = '''
+    WHERE chat_id = ?
+      AND timestamp >= ?
+      AND timestamp < ?
+      AND (thread_id IS NULL OR thread_id NOT IN (SELECT thread_id FROM ignored_threads))
+'''
+HAS_MESSAGES_SQL = (
+    'SELECT EXISTS(SELECT 1 FROM messages' + PERIOD_WHERE + " AND trim(message_text) != '')"
+)
+SELECT_PERIOD_SQL = (
+    'SELECT message_id, username, message_text, timestamp, thread_id FROM messages'
+    + PERIOD_WHERE + 'ORDER BY timestamp ASC'
+)
 
-# --- Сохранение сообщения ---
-def save_message(db_path, message_id, username, message_text, timestamp, chat_id, thread_id):
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    c.execute('''
-        INSERT OR IGNORE INTO messages (message_id, username, message_text, timestamp, chat_id, thread_id)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', (message_id, username, message_text, timestamp, chat_id, thread_id))
-    conn.commit()
-    conn.close()
+# --- Есть ли за период хоть одно непустое сообщение ---
+def has_messages_in_period(conn, chat_id, from_dt, to_dt):
+    # EXISTS останавливается на первой подходящей строке
+    with db_lock:
+        row = conn.execute(HAS_MESSAGES_SQL, (chat_id, to_epoch_us(from_dt), to_epoch_us(to_dt))).fetchone()
+    return bool(row[0])
 
 # --- Получение сообщений за период ---
-def fetch_messages_for_period(db_path, chat_id, from_dt, to_dt, ignored_thread_ids):
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    query = '''
-        SELECT message_id, username, message_text, timestamp, thread_id
-        FROM messages
-        WHERE chat_id = ?
-          AND timestamp >= ?
-          AND timestamp < ?
-    '''
-    params = [chat_id, from_dt.isoformat(), to_dt.isoformat()]
-    if ignored_thread_ids:
-        query += ' AND (thread_id IS NULL OR thread_id NOT IN (%s))' % (
-            ','.join(['?']*len(ignored_thread_ids))
-        )
-        params.extend(ignored_thread_ids)
-    query += ' ORDER BY timestamp ASC'
-    c.execute(query, params)
-    rows = c.fetchall()
-    conn.close()
-    return rows
+def fetch_messages_for_period(conn, chat_id, from_dt, to_dt):
+    # Строки отдаются по одной прямо из курсора; соединение занято, пока генератор не закрыт
+    with db_lock:
+        yield from conn.execute(SELECT_PERIOD_SQL, (chat_id, to_epoch_us(from_dt), to_epoch_us(to_dt)))
+
+# --- Номер дня основы и имя папки дня (dd.mm.yy) ---
+@lru_cache(maxsize=8)
+def day_info(d):
+    return (d - START_DATE).days, d.strftime('%d.%m.%y')
 
 # --- Экспорт сообщений в файл, генерация summary через Gemini ---
-def export_messages(config):
-    tz = pytz.timezone('Europe/Moscow')
-    now = datetime.now(tz)
-    export_time = datetime.combine(now.date(), dt_time.fromisoformat(config['TIME_EXPORT']), tz)
-    if now < export_time:
-        export_time -= timedelta(days=1)
-    from_dt = export_time
-    to_dt = export_time + timedelta(days=1)
-    date_str = to_dt.strftime('%d.%m.%y')  # dd.mm.yy
+def export_messages(config, conn, export_time):
+    # Окно — ровно сутки, заканчивающиеся в export_time; от текущего времени не зависит
+    from_dt = export_time - timedelta(days=1)
+    to_dt = export_time
+    day_number, date_str = day_info(to_dt.date())
     export_dir = Path(MESSAGES_DIR) / date_str
     export_dir.mkdir(parents=True, exist_ok=True)
-
-    messages = fetch_messages_for_period(
-        DB_PATH,
-        config['TARGET_CHAT_ID'],
-        from_dt,
-        to_dt,
-        config['IGNORED_TOPIC_IDS']
-    )
-    logger.info(f"Exporting {len(messages)} messages for {date_str}")
-
-    # Формируем строки
-    lines = [f"{message_id} | {username}: {text}" for message_id, username, text, _, _ in messages]
     fname = export_dir / "messages.txt"
-    with open(fname, 'w', encoding='utf-8') as f:
-        f.write('\n'.join(lines))
-    logger.info(f"Exported all messages to {fname}")
+    period = (config['TARGET_CHAT_ID'], from_dt, to_dt)
 
-    # Проверка на пустой день (только пустые строки/пробелы)
-    if not any(line.strip() for line in lines):
+    # Проверка на пустой день — одним запросом, не вычитывая сами сообщения
+    if not has_messages_in_period(conn, *period):
+        fname.write_text('', encoding='utf-8')
         # Город спит...
-        tz = pytz.timezone('Europe/Moscow')
-        now = datetime.now(tz)
-        start_date = datetime(2025, 4, 23, tzinfo=tz)
-        day_number = (now.date() - start_date.date()).days
         summary_path = export_dir / 'summary.txt'
         msg = f"✨{day_number}-й день основы\n🌙 Город спит..."
         with open(summary_path, 'w', encoding='utf-8') as f:
@@ -158,6 +293,15 @@ def export_messages(config):
         logger.info("No messages for the day. Posted 'Город спит...'")
         return
 
+    # Пишем строки из курсора сразу в файл через большой буфер, без промежуточных списков
+    count = 0
+    with closing(fetch_messages_for_period(conn, *period)) as messages, \
+            open(fname, 'w', encoding='utf-8', buffering=EXPORT_BUFFER_SIZE, newline='') as f:
+        for message_id, username, text, _, _ in messages:
+            f.write(f"{message_id} | {username}: {text}\n")
+            count += 1
+    logger.info(f"Exported {count} messages for {date_str} to {fname}")
+
     # Генерируем summary через Gemini
     try:
         summary = generate_summary_via_gemini(config, fname)
@@ -188,48 +332,41 @@ def generate_summary_via_gemini(config, messages_path):
     )
     return response.text
 
-def escape_markdown_v2(text):
-    # Найти все телеграм-ссылки
-    link_pattern = re.compile(r'\[🔗\]\(https://t\.me/c/\d+/[^)]+\)')
-    # Найти заголовки в формате **Текст**
-    header_pattern = re.compile(r'\*\*([^\*]+)\*\*')
+# Найти телеграм-ссылки или заголовки в формате **Текст**
+LINK_OR_HEADER = re.compile(r'(\[🔗\]\(https://t\.me/c/\d+/[^)]+\))|\*\*([^*]+?)\*\*')
+# Спецсимволы MarkdownV2 (включая обратный слэш) -> экранированные версии
+ESCAPE_TABLE = str.maketrans({c: '\\' + c for c in '_*[]()~>#+-=|{}.!\\'})
 
+def escape_markdown_v2(text):
     result = []
     last_idx = 0
 
     # Обрабатываем текст, учитывая ссылки и заголовки
-    for match in re.finditer(r'(\[🔗\]\(https://t\.me/c/\d+/[^)]+\))|(\*\*[^\*]+\*\*)', text):
+    for match in LINK_OR_HEADER.finditer(text):
         # Экранируем текст до текущего совпадения (ссылки или заголовка)
-        before = text[last_idx:match.start()]
-        special_chars = r'_*[]()~>#+\-=|{}.!'
-        before = re.sub(f'([{re.escape(special_chars)}])', r'\\\1', before)
-        result.append(before)
+        result.append(text[last_idx:match.start()].translate(ESCAPE_TABLE))
 
         # Если это ссылка, добавляем как есть
         if match.group(1):
             result.append(match.group(1))
         # Если это заголовок, преобразуем в *Текст* для жирного начертания
         elif match.group(2):
-            header_text = match.group(2)[2:-2]  # Удаляем ** с начала и конца
-            # Экранируем специальные символы внутри заголовка
-            header_text = re.sub(f'([{re.escape(special_chars)}])', r'\\\1', header_text)
-            result.append(f'*{header_text}*')
+            # Группа захватывает текст заголовка уже без ** по краям;
+            # экранируем специальные символы внутри заголовка
+            result.append(f'*{match.group(2).translate(ESCAPE_TABLE)}*')
 
         last_idx = match.end()
 
     # Экранируем остаток текста после последнего совпадения
-    special_chars = r'_*[]()~>#+\-=|{}.!'
-    after = text[last_idx:]
-    after = re.sub(f'([{re.escape(special_chars)}])', r'\\\1', after)
-    result.append(after)
+    result.append(text[last_idx:].translate(ESCAPE_TABLE))
 
     return ''.join(result)
 
 # --- Публикация summary ---
-async def post_summary(config, application):
-    tz = pytz.timezone('Europe/Moscow')
-    now = datetime.now(tz)
-    date_str = now.strftime('%d.%m.%y')  # dd.mm.yy
+logins_cache = {'mtime': 0, 'content': ''}
+
+async def post_summary(config, application, post_time):
+    day_number, date_str = day_info(post_time.date())
     export_dir = Path(MESSAGES_DIR) / date_str
     summary_path = export_dir / 'summary.txt'
     if not summary_path.exists():
@@ -241,8 +378,6 @@ async def post_summary(config, application):
     if len(summary) > config['MAX_SUMMARY_SIZE']:
         logger.warning(f"Summary exceeds MAX_SUMMARY_SIZE ({len(summary)} > {config['MAX_SUMMARY_SIZE']})")
         return
-    start_date = datetime(2025, 4, 23, tzinfo=tz)
-    day_number = (now.date() - start_date.date()).days
     # Если в summary уже содержится 'Город спит...', просто отправляем его
     if 'Город спит...' in summary:
         msg = summary
@@ -252,8 +387,12 @@ async def post_summary(config, application):
     logins_path = Path('logins.txt')
     if logins_path.exists():
         try:
-            with open(logins_path, encoding='utf-8') as f:
-                logins_content = f.read().strip()
+            # Перечитываем файл только если он изменился с прошлого раза
+            st = logins_path.stat()
+            if st.st_mtime_ns != logins_cache['mtime']:
+                logins_cache['content'] = logins_path.read_text(encoding='utf-8').strip()
+                logins_cache['mtime'] = st.st_mtime_ns
+            logins_content = logins_cache['content']
             if logins_content:
                 msg += f"\n\n{logins_content}"
         except Exception as e:
@@ -276,34 +415,28 @@ async def post_summary(config, application):
         logger.error(f"Failed to post summary: {e}")
 
 # --- Планировщик задач ---
-async def scheduler(config, application):
-    tz = pytz.timezone('Europe/Moscow')
-    last_export_date = None
-    last_post_date = None
+async def run_daily_at(event_time, tz, job, *args):
+    # Каждое событие — отдельная задача, которая спит ровно до следующего запуска;
+    # в job последним аргументом передается плановое время запуска, а не фактическое
+    last_run = None
     while True:
         now = datetime.now(tz)
-        # Экспорт сообщений
-        export_time = dt_time.fromisoformat(config['TIME_EXPORT'])
-        naive_export_dt = datetime.combine(now.date(), export_time)  # naive datetime
-        next_export = tz.localize(naive_export_dt)
-        if now >= next_export:
-            next_export += timedelta(days=1)
-        # Публикация summary
-        post_time = dt_time.fromisoformat(config['TIME_POST'])
-        naive_post_dt = datetime.combine(now.date(), post_time)  # naive datetime
-        next_post = tz.localize(naive_post_dt)
-        if now >= next_post:
-            next_post += timedelta(days=1)
-        # Sleep до ближайшего события
-        sleep_seconds = min((next_export - now).total_seconds(), (next_post - now).total_seconds())
-        await asyncio.sleep(max(1, int(sleep_seconds)))
-        now = datetime.now(tz)
-        if abs((now - next_export).total_seconds()) < 60 and last_export_date != now.date():
-            export_messages(config)
-            last_export_date = now.date()
-        if abs((now - next_post).total_seconds()) < 60 and last_post_date != now.date():
-            await post_summary(config, application)
-            last_post_date = now.date()
+        if last_run is not None and now < last_run:
+            now = last_run  # sleep мог проснуться чуть раньше срока
+        next_run = datetime.combine(now.date(), event_time, tz)
+        if now >= next_run:
+            next_run += timedelta(days=1)
+        await asyncio.sleep((next_run - datetime.now(tz)).total_seconds())
+        last_run = next_run
+        try:
+            await job(*args, next_run)
+        except Exception as e:
+            logger.error(f"Scheduled job {job.__name__} failed: {e}")
+
+async def export_job(config, application, export_time):
+    # Сначала дожидаемся записи всех сообщений из очереди
+    await application.bot_data['writer'].flush()
+    await asyncio.to_thread(export_messages, config, application.bot_data['db'], export_time)
 
 # --- Обработчик сообщений ---
 async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -317,7 +450,7 @@ async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Игнорировать репосты из каналов
     if getattr(msg, 'forward_from_chat', None) is not None and getattr(msg.forward_from_chat, 'type', None) == 'channel':        return
     # Игнорировать личные сообщения и другие группы
-    if chat.type not in ['group', 'supergroup']:
+    if chat.type not in GROUP_CHAT_TYPES:
         return
     # Игнорировать команды
     if msg.text and msg.text.startswith('/'):
@@ -333,35 +466,52 @@ async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     if len(message_text) > 850:
         return
-    timestamp = datetime.fromtimestamp(msg.date.timestamp(), pytz.UTC).astimezone(pytz.timezone('Europe/Moscow')).isoformat()
-    save_message(
-        DB_PATH,
+    timestamp = to_epoch_us(msg.date)
+    context.bot_data['writer'].add((
         msg.message_id,
         username,
         message_text,
         timestamp,
         chat.id,
         thread_id
-    )
-    logger.info(f"Saved message from {username} (id={msg.message_id})")
+    ))
+    # Поштучный лог только в DEBUG; на INFO остается сводка MessageWriter о записанной пачке
+    logger.debug("Queued message id=%d from %s", msg.message_id, username)
+
+# --- Запуск и остановка писателя ---
+async def on_startup(application):
+    await application.bot_data['writer'].start(DB_PATH)
+
+async def on_shutdown(application):
+    await application.bot_data['writer'].close()
 
 # --- Main ---
 def main():
     # Проверка путей
     Path(MESSAGES_DIR).mkdir(exist_ok=True)
     config = read_config(CONFIG_PATH)
-    init_db(DB_PATH)
+    conn = open_db(DB_PATH)
+    init_db(conn, config['IGNORED_TOPIC_IDS'])
 
     # Запуск бота
-    application = ApplicationBuilder().token(config['TOKEN']).build()
+    application = (
+        ApplicationBuilder()
+        .token(config['TOKEN'])
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     application.bot_data['config'] = config
+    application.bot_data['db'] = conn
+    application.bot_data['writer'] = MessageWriter(interval=config['FLUSH_INTERVAL'])
 
     # Обработка всех текстовых сообщений
     application.add_handler(MessageHandler(filters.ALL, on_message))
 
     # Планировщик
     loop = asyncio.get_event_loop()
-    loop.create_task(scheduler(config, application))
+    loop.create_task(run_daily_at(config['TIME_EXPORT'], config['TZ'], export_job, config, application))
+    loop.create_task(run_daily_at(config['TIME_POST'], config['TZ'], post_summary, config, application))
 
     logger.info("Bot started.")
     application.run_polling()